@@ -1,14 +1,34 @@
 import re
+from functools import lru_cache
 from typing import Dict, List, Set, Tuple, Union, Any
 import numpy as np
 import torch
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 from transformers import LongformerTokenizer, LongformerForMultipleChoice
-from selfcheckgpt.utils import prepare_qa_input, prepare_distractor_input, prepare_answering_input
-from selfcheckgpt.utils import MQAGConfig, get_prob_distances
+from selfcheckgpt.utils import prepare_qa_input, prepare_distractor_input, prepare_distractor_input_batch, prepare_answering_input_batch
+from selfcheckgpt.utils import MQAGConfig, get_prob_distances, get_attention_window
 
 # ---------------------------------------------------------------------------------------- #
 # Functions for Question Generation & Answering
+_EXTRA_ID_RE = re.compile(r"<extra\S+>")
+
+@lru_cache(maxsize=None)
+def _pad_eos_re(pad_token, eos_token):
+    return re.compile(re.escape(pad_token) + "|" + re.escape(eos_token))
+
+def remove_pad_eos(text, t5_tokenizer):
+    """
+    remove the pad & eos tokens from a decoded T5 output in one pass
+    """
+    return _pad_eos_re(t5_tokenizer.pad_token, t5_tokenizer.eos_token).sub("", text)
+
+def build_options(answer, distractors):
+    """
+    exactly 4 options: repeat the last distractor if G2 gave fewer than 3, drop the extra ones if more
+    :param distractors: list[str] -- non-empty, as given by str.split
+    """
+    return ([answer] + distractors + [distractors[-1]] * 3)[:4]
+
 def question_generation_sentence_level(
     g1_model,
     g1_tokenizer,
@@ -18,55 +38,62 @@ def question_generation_sentence_level(
     passage,
     num_questions_per_sent,
     device,
+    max_new_tokens=128,
 ):
+    """
+    :param max_new_tokens: decoding budget of G1 & G2, lowering it can cut off the answer or the last distractor
+    """
     qa_input_ids = prepare_qa_input(
             g1_tokenizer,
             context=sentence,
             device=device,
     )
-    num_valid_questions = 0
-    questions = []
-    for q_ in range(num_questions_per_sent):
-        # Stage G.1: question+answer generation
-        outputs = g1_model.generate(
-            qa_input_ids,
-            max_new_tokens=128,
-            do_sample=True,
-        )
-        question_answer = g1_tokenizer.decode(outputs[0], skip_special_tokens=False)
-        question_answer = question_answer.replace(g1_tokenizer.pad_token, "").replace(g1_tokenizer.eos_token, "")
+    # Stage G.1: question+answer generation (all questions are sampled in one batched call)
+    outputs = g1_model.generate(
+        qa_input_ids,
+        max_new_tokens=max_new_tokens,
+        do_sample=True,
+        num_beams=1,
+        use_cache=True,
+        pad_token_id=g1_tokenizer.pad_token_id,
+        num_return_sequences=num_questions_per_sent,
+    )
+    question_answers = g1_tokenizer.batch_decode(outputs, skip_special_tokens=False)
+    valid_questions, valid_answers = [], []
+    for question_answer in question_answers:
+        question_answer = remove_pad_eos(question_answer, g1_tokenizer)
         question_answer_split = question_answer.split(g1_tokenizer.sep_token)
         if len(question_answer_split) == 2:
             # valid Question + Annswer output
-            num_valid_questions += 1
-        else:
-            continue
-        question = question_answer_split[0].strip()
-        answer = question_answer_split[1].strip()
+            valid_questions.append(question_answer_split[0].strip())
+            valid_answers.append(question_answer_split[1].strip())
+    if len(valid_questions) == 0:
+        return []
 
-        # Stage G.2: Distractor Generation
-        distractor_input_ids = prepare_distractor_input(
-            g2_tokenizer,
-            context = passage,
-            question = question,
-            answer = answer,
-            device = device,
-            separator = g2_tokenizer.sep_token,
-        )
-        outputs = g2_model.generate(
-            distractor_input_ids,
-            max_new_tokens=128,
-            do_sample=True,
-        )
-        distractors = g2_tokenizer.decode(outputs[0], skip_special_tokens=False)
-        distractors = distractors.replace(g2_tokenizer.pad_token, "").replace(g2_tokenizer.eos_token, "")
-        distractors = re.sub("<extra\S+>", g2_tokenizer.sep_token, distractors)
-        distractors = [y.strip() for y in distractors.split(g2_tokenizer.sep_token)]
-        options = [answer] + distractors
+    # Stage G.2: Distractor Generation (one batched call over all valid questions)
+    distractor_inputs = prepare_distractor_input_batch(
+        g2_tokenizer,
+        context = passage,
+        questions = valid_questions,
+        answers = valid_answers,
+        device = device,
+        separator = g2_tokenizer.sep_token,
+    )
+    outputs = g2_model.generate(
+        **distractor_inputs,
+        max_new_tokens=max_new_tokens,
+        do_sample=True,
+        num_beams=1,
+        use_cache=True,
+        pad_token_id=g2_tokenizer.pad_token_id,
+    )
+    distractors_batch = g2_tokenizer.batch_decode(outputs, skip_special_tokens=False)
 
-        while len(options) < 4:
-            # print("Warning: options =", options)
-            options.append(options[-1])
+    questions = []
+    for question, answer, distractors in zip(valid_questions, valid_answers, distractors_batch):
+        distractors = _EXTRA_ID_RE.sub(g2_tokenizer.sep_token, remove_pad_eos(distractors, g2_tokenizer))
+        distractors = [y.strip() for y in distractors.split(g2_tokenizer.sep_token)]
+        options = build_options(answer, distractors)
 
         question_item = {
             'question': question,
@@ -101,7 +128,7 @@ def question_generation_sampling(
             do_sample=True,
         )
         question_answer = g1_tokenizer.decode(outputs[0], skip_special_tokens=False)
-        question_answer = question_answer.replace(g1_tokenizer.pad_token, "").replace(g1_tokenizer.eos_token, "")
+        question_answer = remove_pad_eos(question_answer, g1_tokenizer)
         question_answer_split = question_answer.split(g1_tokenizer.sep_token)
         if len(question_answer_split) == 2:
             # valid Question + Annswer output
@@ -126,13 +153,9 @@ def question_generation_sampling(
             do_sample=True,
         )
         distractors = g2_tokenizer.decode(outputs[0], skip_special_tokens=False)
-        distractors = distractors.replace(g2_tokenizer.pad_token, "").replace(g2_tokenizer.eos_token, "")
-        distractors = re.sub("<extra\S+>", g2_tokenizer.sep_token, distractors)
+        distractors = _EXTRA_ID_RE.sub(g2_tokenizer.sep_token, remove_pad_eos(distractors, g2_tokenizer))
         distractors = [y.strip() for y in distractors.split(g2_tokenizer.sep_token)]
-        options = [answer] + distractors
-
-        while len(options) < 4:
-            options.append(options[-1])
+        options = build_options(answer, distractors)
 
         question_item = {
             'question': question,
@@ -165,7 +188,7 @@ def question_generation_beamsearch(
         num_beams=num_beams,
     )
     question_answer = g1_tokenizer.decode(outputs[0], skip_special_tokens=False)
-    question_answer = question_answer.replace(g1_tokenizer.pad_token, "").replace(g1_tokenizer.eos_token, "")
+    question_answer = remove_pad_eos(question_answer, g1_tokenizer)
     question_answer_split = question_answer.split(g1_tokenizer.sep_token)
     if len(question_answer_split) == 2:
         question = question_answer_split[0].strip()
@@ -190,13 +213,9 @@ def question_generation_beamsearch(
         num_beams=num_beams,
     )
     distractors = g2_tokenizer.decode(outputs[0], skip_special_tokens=False)
-    distractors = distractors.replace(g2_tokenizer.pad_token, "").replace(g2_tokenizer.eos_token, "")
-    distractors = re.sub("<extra\S+>", g2_tokenizer.sep_token, distractors)
+    distractors = _EXTRA_ID_RE.sub(g2_tokenizer.sep_token, remove_pad_eos(distractors, g2_tokenizer))
     distractors = [y.strip() for y in distractors.split(g2_tokenizer.sep_token)]
-    options = [answer] + distractors
-
-    while len(options) < 4:
-        options.append(options[-1])
+    options = build_options(answer, distractors)
 
     question_item = {
         'question': question,
@@ -214,17 +233,43 @@ def answering(
     max_seq_length,
     device,
 ):
-    answering_given_passage = prepare_answering_input(
+    prob = answering_batch(
+        a_model, a_tokenizer,
+        [question], [options], [context],
+        max_seq_length, device,
+    )[0].cpu().numpy()
+    return prob
+
+def answering_batch(
+    a_model,
+    a_tokenizer,
+    questions,
+    options,
+    contexts,
+    max_seq_length,
+    device,
+    softmax=True,
+):
+    """
+    batched version of answering -- a single forward pass where the i-th example is (questions[i], options[i], contexts[i])
+    :param softmax: if False, return the logits, e.g. when only the argmax is needed
+    :return probs: torch.Tensor of dimension (batch_size, num_options) on device
+    """
+    # padding to the attention window here saves the model from re-padding, and keeps the number of distinct shapes small
+    answering_given_passages = prepare_answering_input_batch(
         tokenizer=a_tokenizer,
-        question=question,
+        questions=questions,
         options=options,
-        context=context,
+        contexts=contexts,
         device=device,
         max_seq_length=max_seq_length,
+        pad_to_multiple_of=get_attention_window(a_model.config),
     )
-    answering_outputs = a_model(**answering_given_passage)
-    prob = torch.softmax(answering_outputs['logits'], dim=-1)[0].cpu().numpy()
-    return prob
+    answering_outputs = a_model(**answering_given_passages)
+    if not softmax:
+        return answering_outputs['logits']
+    probs = torch.softmax(answering_outputs['logits'].float(), dim=-1)
+    return probs
 
 # ---------------------------------------------------------------------------------------- #
 # Main MQAG class
@@ -356,13 +401,13 @@ class MQAG:
             self.inti_answering = True
 
         num_questions = len(questions)
-        probs = np.zeros((num_questions, 4))
+        # filled on device and copied to host once, rather than one blocking copy per question
+        probs = torch.empty((num_questions, 4), device=self.device)
         for i, question_item in enumerate(questions):
             question, options = question_item['question'], question_item['options']
-            prob = answering(
+            probs[i] = answering_batch(
                 self.a_model, self.a_tokenizer,
-                question, options, context,
+                [question], [options], [context],
                 max_seq_length=4096, device=self.device,
-            )
-            probs[i] = prob
-        return probs
+            )[0]
+        return probs.cpu().numpy().astype(np.float64)
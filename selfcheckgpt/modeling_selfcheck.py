@@ -1,19 +1,49 @@
+import math
 import spacy
 import bert_score
 import numpy as np
 import torch
 from typing import Dict, List, Set, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from transformers import logging
 logging.set_verbosity_error()
 
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 from transformers import LongformerTokenizer, LongformerForMultipleChoice, LongformerForSequenceClassification
-from selfcheckgpt.utils import MQAGConfig, expand_list1, expand_list2
-from selfcheckgpt.modeling_mqag import question_generation_sentence_level, answering
+from selfcheckgpt.utils import MQAGConfig, expand_list1, expand_list2, get_attention_window
+from selfcheckgpt.modeling_mqag import question_generation_sentence_level, answering_batch
 from selfcheckgpt.modeling_ngram import UnigramModel, NgramModel
 
 # ---------------------------------------------------------------------------------------- #
 # Functions for counting
+# inputs are torch tensors kept on the model's device, optionally with a leading dimension over questions,
+# i.e. prob: (..., 4), u_score: (...), prob_s: (..., num_samples, 4), u_score_s: (..., num_samples)
+def _log_power(base, exponent):
+    """
+    log(base^exponent), where base = 0 (i.e. beta1 or beta2 = 0) gives -inf, and 0^0 = 1 as in the original scoring
+    """
+    if base > 0:
+        return exponent * math.log(base)
+    # counts can be integer tensors (counting), the log is a float
+    return torch.where(
+        exponent > 0,
+        torch.full_like(exponent, -math.inf, dtype=torch.float),
+        torch.zeros_like(exponent, dtype=torch.float),
+    )
+
+def bayes_score(count_match, count_mismatch, beta1, beta2):
+    """
+    P(sentence is non-factual | count_match, count_mismatch) = gamma2^mismatch / (gamma1^match + gamma2^mismatch)
+    computed in the log domain so that large counts do not overflow
+    """
+    gamma1 = beta2 / (1.0-beta1)
+    gamma2 = beta1 / (1.0-beta2)
+    log_numerator = _log_power(gamma2, count_mismatch)
+    log_denominator = torch.logaddexp(_log_power(gamma1, count_match), log_numerator)
+    score = torch.exp(log_numerator - log_denominator)
+    return score
+
 def method_simple_counting(
     prob,
     u_score,
@@ -26,21 +56,14 @@ def method_simple_counting(
     simple counting method score => count_mismatch / (count_match + count_mismatch)
     :return score: 'inconsistency' score
     """
-    # bad questions, i.e. not answerable given the passage
-    if u_score < AT:
-        return 0.5
-    a_DT = np.argmax(prob)
-    count_good_sample, count_match = 0, 0
-    for s in range(num_samples):
-        if u_score_s[s] >= AT:
-            count_good_sample += 1
-            a_S = np.argmax(prob_s[s])
-            if a_DT == a_S:
-                count_match += 1
-    if count_good_sample == 0:
-        score = 0.5
-    else:
-        score = (count_good_sample-count_match) / count_good_sample
+    a_DT = torch.argmax(prob, dim=-1).unsqueeze(-1)
+    a_S = torch.argmax(prob_s, dim=-1)
+    good_sample = u_score_s >= AT
+    count_good_sample = good_sample.sum(dim=-1)
+    count_match = (good_sample & (a_S == a_DT)).sum(dim=-1)
+    score = (count_good_sample-count_match) / count_good_sample.clamp(min=1)
+    # bad questions, i.e. not answerable given the passage, or no good samples
+    score = torch.where((u_score < AT) | (count_good_sample == 0), torch.full_like(score, 0.5), score)
     return score
 
 def method_vanilla_bayes(
@@ -55,20 +78,13 @@ def method_vanilla_bayes(
     (vanilla) bayes method score: compute P(sentence is non-factual | count_match, count_mismatch)
     :return score: 'inconsistency' score
     """
-    if u_score < AT:
-        return 0.5
-    a_DT = np.argmax(prob)
-    count_match, count_mismatch = 0, 0
-    for s in range(num_samples):
-        if u_score_s[s] >= AT:
-            a_S = np.argmax(prob_s[s])
-            if a_DT == a_S:
-                count_match += 1
-            else:
-                count_mismatch += 1
-    gamma1 = beta2 / (1.0-beta1)
-    gamma2 = beta1 / (1.0-beta2)
-    score = (gamma2**count_mismatch) / ((gamma1**count_match) + (gamma2**count_mismatch))
+    a_DT = torch.argmax(prob, dim=-1).unsqueeze(-1)
+    a_S = torch.argmax(prob_s, dim=-1)
+    good_sample = u_score_s >= AT
+    count_match = (good_sample & (a_S == a_DT)).sum(dim=-1)
+    count_mismatch = good_sample.sum(dim=-1) - count_match
+    score = bayes_score(count_match, count_mismatch, beta1, beta2)
+    score = torch.where(u_score < AT, torch.full_like(score, 0.5), score)
     return score
 
 def method_bayes_with_alpha(
@@ -83,20 +99,20 @@ def method_bayes_with_alpha(
     bayes method (with answerability score, i.e. soft-counting) score
     :return score: 'inconsistency' score
     """
-    a_DT = np.argmax(prob)
-    count_match, count_mismatch = 0, 0
-    for s in range(num_samples):
-        ans_score = u_score_s[s]
-        a_S = np.argmax(prob_s[s])
-        if a_DT == a_S:
-            count_match += ans_score
-        else:
-            count_mismatch += ans_score
-    gamma1 = beta2 / (1.0-beta1)
-    gamma2 = beta1 / (1.0-beta2)
-    score = (gamma2**count_mismatch) / ((gamma1**count_match) + (gamma2**count_mismatch))
+    a_DT = torch.argmax(prob, dim=-1).unsqueeze(-1)
+    a_S = torch.argmax(prob_s, dim=-1)
+    count_match = (u_score_s * (a_S == a_DT)).sum(dim=-1)
+    count_mismatch = u_score_s.sum(dim=-1) - count_match
+    score = bayes_score(count_match, count_mismatch, beta1, beta2)
     return score
 
+# scoring_method -> (function, names of its additional params)
+SCORING_METHODS = {
+    'counting': (method_simple_counting, ['AT']),
+    'bayes': (method_vanilla_bayes, ['beta1', 'beta2', 'AT']),
+    'bayes_with_alpha': (method_bayes_with_alpha, ['beta1', 'beta2']),
+}
+
 def answerability_scoring(
     u_model,
     u_tokenizer,
@@ -108,13 +124,105 @@ def answerability_scoring(
     """
     :return prob: prob -> 0.0 means unanswerable, prob -> 1.0 means answerable
     """
-    input_text = question + ' ' + u_tokenizer.sep_token + ' ' + context
-    inputs = u_tokenizer(input_text, max_length=max_length, truncation=True, return_tensors="pt")
+    prob = answerability_scoring_batch(
+        u_model, u_tokenizer,
+        [question], [context],
+        max_length, device,
+    )[0].item()
+    return prob
+
+def answerability_scoring_batch(
+    u_model,
+    u_tokenizer,
+    questions,
+    contexts,
+    max_length,
+    device,
+):
+    """
+    batched version of answerability_scoring -- a single forward pass where the i-th example is (questions[i], contexts[i])
+    :return probs: torch.Tensor of dimension (batch_size,) on device
+    """
+    input_texts = [question + ' ' + u_tokenizer.sep_token + ' ' + context for question, context in zip(questions, contexts)]
+    inputs = u_tokenizer(
+        input_texts,
+        max_length=max_length,
+        truncation=True,
+        padding="longest",
+        pad_to_multiple_of=get_attention_window(u_model.config),
+        return_tensors="pt",
+    )
     inputs = inputs.to(device)
     logits = u_model(**inputs).logits
     logits = logits.squeeze(-1)
-    prob = torch.sigmoid(logits).item()
-    return prob
+    probs = torch.sigmoid(logits.float())
+    return probs
+
+def compile_longformer(model, mode="reduce-overhead"):
+    """
+    torch.compile the feed-forward blocks of every Longformer layer (in place)
+    the global attention path depends on the number of global tokens and does not trace, so it is kept in eager mode
+    """
+    for layer in model.longformer.encoder.layer:
+        layer.intermediate = torch.compile(layer.intermediate, mode=mode)
+        layer.output = torch.compile(layer.output, mode=mode)
+    return model
+
+class AsyncRunner:
+    """
+    runs jobs in submission order on a worker thread with its own CUDA stream, so that they overlap with the work of the calling thread
+    a thread is needed (not only a stream) as the Longformer forward syncs with the host at every layer
+    if stream is None, e.g. on CPU, jobs are simply run inline
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.futures = []
+        if stream is not None:
+            # jobs come after the work already queued on the current stream, e.g. allocating the output buffers
+            stream.wait_stream(torch.cuda.current_stream(stream.device))
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _run(self, fn, args):
+        # grad mode and the current stream are thread-local
+        with torch.inference_mode(), torch.cuda.stream(self.stream):
+            fn(*args)
+
+    def submit(self, fn, *args):
+        if self.stream is None:
+            fn(*args)
+        else:
+            self.futures.append(self.executor.submit(self._run, fn, args))
+
+    def join(self):
+        """
+        waits for all jobs, re-raising the first error (the jobs not started yet are then cancelled)
+        """
+        if self.stream is None:
+            return
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        cancels the jobs not started yet and waits for the running one, e.g. when the calling thread fails
+        """
+        if self.stream is None:
+            return
+        self.executor.shutdown(cancel_futures=True)
+        # the buffers written by the jobs are used (or freed) on the current stream afterwards
+        torch.cuda.current_stream(self.stream.device).wait_stream(self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.join()
+        else:
+            self.close()
 
 class SelfCheckMQAG:
     """
@@ -126,43 +234,86 @@ class SelfCheckMQAG:
         g2_model: str = None,
         answering_model: str = None,
         answerability_model: str = None,
-        device = None
+        device = None,
+        torch_dtype = None,
+        torch_compile: bool = False,
+        quantize: bool = False,
+        overlap: bool = False,
     ):
+        """
+        :param torch_dtype: dtype of the four models, defaults to torch.bfloat16 on Ampere or newer GPUs, otherwise torch.float32
+        :param quantize: whether to apply int8 dynamic quantization to the answering & answerability models (float32 on CPU only)
+        :param torch_compile: whether to torch.compile the answering & answerability models (requires torch>=2.0),
+            this adds a warmup cost to the first calls so it only pays off on long runs
+        :param overlap: (experimental, GPU only) whether to run the answering & answerability batches on a worker thread with its own CUDA stream,
+            overlapping them with question generation, not supported with torch_compile (CUDA graphs would be replayed from another thread)
+        """
 
         g1_model = g1_model if g1_model is not None else MQAGConfig.generation1_squad
         g2_model = g2_model if g2_model is not None else MQAGConfig.generation2
         answering_model = answering_model if answering_model is not None else MQAGConfig.answering
         answerability_model = answerability_model if answerability_model is not None else MQAGConfig.answerability
 
+        if device is None:
+            device = torch.device("cpu")
+        device = torch.device(device)
+        if torch_dtype is None:
+            # bf16 halves memory traffic and runs on tensor cores; softmax/sigmoid outputs are still computed in fp32
+            # only Ampere (sm_80) and newer have bf16 tensor cores, older GPUs would emulate it (slower) so they keep fp32
+            if device.type == "cuda" and torch.cuda.get_device_capability(device) >= (8, 0):
+                torch_dtype = torch.bfloat16
+            else:
+                torch_dtype = torch.float32
+        if quantize and (device.type != "cpu" or torch_dtype != torch.float32):
+            raise ValueError("quantize is only supported for float32 models on CPU")
+        if overlap and (device.type != "cuda" or torch_compile):
+            raise ValueError("overlap is only supported on GPU without torch_compile")
+
         # Question Generation Systems (G1 & G2)
         self.g1_tokenizer = AutoTokenizer.from_pretrained(g1_model)
-        self.g1_model = AutoModelForSeq2SeqLM.from_pretrained(g1_model)
+        self.g1_model = AutoModelForSeq2SeqLM.from_pretrained(g1_model, torch_dtype=torch_dtype)
         self.g2_tokenizer = AutoTokenizer.from_pretrained(g2_model)
-        self.g2_model = AutoModelForSeq2SeqLM.from_pretrained(g2_model)
+        self.g2_model = AutoModelForSeq2SeqLM.from_pretrained(g2_model, torch_dtype=torch_dtype)
 
         # Question Answering System (A)
         self.a_tokenizer = LongformerTokenizer.from_pretrained(answering_model)
-        self.a_model = LongformerForMultipleChoice.from_pretrained(answering_model)
+        self.a_model = LongformerForMultipleChoice.from_pretrained(answering_model, torch_dtype=torch_dtype)
 
         # (Un)Answerability System (U)
         self.u_tokenizer = LongformerTokenizer.from_pretrained(answerability_model)
-        self.u_model = LongformerForSequenceClassification.from_pretrained(answerability_model)
+        # A & U are both fine-tuned from longformer-large-4096: share one tokenizer (and its BPE cache) when the vocab is the same
+        if self.u_tokenizer.get_vocab() == self.a_tokenizer.get_vocab() and \
+            self.u_tokenizer.all_special_tokens == self.a_tokenizer.all_special_tokens:
+            self.u_tokenizer = self.a_tokenizer
+        self.u_model = LongformerForSequenceClassification.from_pretrained(answerability_model, torch_dtype=torch_dtype)
 
         self.g1_model.eval()
         self.g2_model.eval()
         self.a_model.eval()
         self.u_model.eval()
 
-        if device is None:
-            device = torch.device("cpu")
         self.g1_model.to(device)
         self.g2_model.to(device)
         self.a_model.to(device)
         self.u_model.to(device)
         self.device = device
-        print("SelfCheck-MQAG initialized to device", device)
+        # stream for the answering & answerability batches, so that they overlap with question generation
+        # (opt-in) otherwise the batches run inline on the calling thread
+        self.answering_stream = torch.cuda.Stream(device) if overlap else None
 
-    @torch.no_grad()
+        if quantize:
+            # int8 weights for the Linear layers, where most of the Longformer compute is
+            self.a_model = torch.quantization.quantize_dynamic(self.a_model, {torch.nn.Linear}, dtype=torch.qint8)
+            self.u_model = torch.quantization.quantize_dynamic(self.u_model, {torch.nn.Linear}, dtype=torch.qint8)
+        if torch_compile:
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("torch_compile requires torch>=2.0")
+            # the T5 generators are left as is: .generate() decodes with growing shapes and would keep recompiling
+            compile_longformer(self.a_model)
+            compile_longformer(self.u_model)
+        print("SelfCheck-MQAG initialized to device", device, torch_dtype)
+
+    @torch.inference_mode()
     def predict(
         self,
         sentences: List[str],
@@ -170,6 +321,8 @@ class SelfCheckMQAG:
         sampled_passages: List[str],
         num_questions_per_sent: int = 5,
         scoring_method: str = "bayes_with_alpha",
+        batch_size: int = 2,
+        max_new_tokens: int = 128,
         **kwargs,
     ):
         """
@@ -178,61 +331,139 @@ class SelfCheckMQAG:
         :param passage: str -- the passage to be evaluated, note that splitting(passage) ---> sentences
         :param sampled_passages: list[str] -- stochastically generated responses (without sentence splitting)
         :param num_questions_per_sent: int -- number of quetions to be generated per sentence
+        :param batch_size: int -- number of (question, passage) pairs per answering & answerability forward pass,
+            note that each pair is 4 sequences (one per option) for the answering model, i.e. its forwards are 4*batch_size sequences of up to 4096 tokens,
+            batch_size=1 keeps the memory footprint of the unbatched implementation
+        :param max_new_tokens: int -- decoding budget of the question & distractor generation
         :return sent_scores: sentence-level score of the same length as len(sentences) # inconsistency_score, i.e. higher means likely hallucination
         """
-        assert scoring_method in ['counting', 'bayes', 'bayes_with_alpha']
+        assert scoring_method in SCORING_METHODS
+        method, method_params = SCORING_METHODS[scoring_method]
+        score_fn = partial(method, **{name: kwargs[name] for name in method_params})
         num_samples = len(sampled_passages)
-        sent_scores = []
-        for sentence in sentences:
-
-            # Question + Choices Generation
-            questions = question_generation_sentence_level(
-                self.g1_model, self.g1_tokenizer,
-                self.g2_model, self.g2_tokenizer,
-                sentence, passage, num_questions_per_sent, self.device)
-
-            # Answering
-            scores = []
-            max_seq_length = 4096 # answering & answerability max length
-            for question_item in questions:
-                question, options = question_item['question'], question_item['options']
-                # response
-                prob = answering(
-                    self.a_model, self.a_tokenizer,
-                    question, options, passage,
-                    max_seq_length, self.device)
-
-                u_score = answerability_scoring(
-                    self.u_model, self.u_tokenizer,
-                    question, passage,
-                    max_seq_length, self.device)
-
-                prob_s = np.zeros((num_samples, 4))
-                u_score_s = np.zeros((num_samples,))
-                for si, sampled_passage in enumerate(sampled_passages):
-
-                    # sample
-                    prob_s[si] = answering(
-                        self.a_model, self.a_tokenizer,
-                        question, options, sampled_passage,
-                        max_seq_length, self.device)
-                    u_score_s[si] = answerability_scoring(
-                        self.u_model, self.u_tokenizer,
-                        question, sampled_passage,
-                        max_seq_length, self.device)
-
-                # doing comparision
-                if scoring_method == 'counting':
-                    score = method_simple_counting(prob, u_score, prob_s, u_score_s, num_samples, AT=kwargs['AT'])
-                elif scoring_method == 'bayes':
-                    score = method_vanilla_bayes(prob, u_score, prob_s, u_score_s, num_samples, beta1=kwargs['beta1'], beta2=kwargs['beta2'], AT=kwargs['AT'])
-                elif scoring_method == 'bayes_with_alpha':
-                    score = method_bayes_with_alpha(prob, u_score, prob_s, u_score_s, num_samples, beta1=kwargs['beta1'], beta2=kwargs['beta2'])
-                scores.append(score)
-            sent_score = np.mean(scores)
-            sent_scores.append(sent_score)
-
-        return np.array(sent_scores)
+        contexts = [passage] + sampled_passages # index 0 is the response, 1: are the samples
+        num_contexts = len(contexts)
+        max_seq_length = 4096 # answering & answerability max length
+
+        # the (question, context) pairs are batched in order of context length (across questions),
+        # so that each batch holds contexts of similar length and is padded as little as possible
+        context_lengths = [len(self.a_tokenizer(context, truncation=True, max_length=max_seq_length).input_ids) for context in contexts]
+        order = np.argsort(context_lengths, kind="stable")
+        sorted_contexts = [contexts[i] for i in order]
+        inv_order = torch.as_tensor(np.argsort(order), device=self.device)
+        # answerability on the passage is computed separately (see below), so only the samples are batched for it
+        sample_order = [i - 1 for i in order if i != 0]
+        sorted_samples = [sampled_passages[i] for i in sample_order]
+        inv_sample_order = torch.as_tensor(np.argsort(sample_order), device=self.device)
+
+        # outputs are written batch by batch into on-device buffers, sized for the maximum number of questions
+        max_num_questions = len(sentences) * num_questions_per_sent
+        # the scoring methods only take the argmax of the answering probabilities, so the logits are kept instead (softmax is monotonic)
+        logits = torch.empty((max_num_questions * num_contexts, 4), device=self.device)
+        u_scores_passage = torch.empty((max_num_questions,), device=self.device)
+        u_scores = torch.empty((max_num_questions * num_samples,), device=self.device)
+        # (question, options, context), question and (question, sample) in buffer order,
+        # i.e. the pair of the k-th shortest context of a question is at index question_row * num_contexts + k
+        a_examples, p_examples, u_examples = [], [], []
+        a_pending, u_pending = [], [] # indices of the pairs not launched yet
+
+        def answer(indices):
+            questions_b, options_b, contexts_b = zip(*[a_examples[i] for i in indices])
+            logits[torch.as_tensor(indices, device=self.device)] = answering_batch(
+                self.a_model, self.a_tokenizer,
+                questions_b, options_b, contexts_b,
+                max_seq_length, self.device, softmax=False)
+
+        def score_passage_answerability(start, end):
+            u_scores_passage[start:end] = answerability_scoring_batch(
+                self.u_model, self.u_tokenizer,
+                p_examples[start:end], [passage] * (end - start),
+                max_seq_length, self.device)
+
+        def score_answerability(indices):
+            questions_b, contexts_b = zip(*[u_examples[i] for i in indices])
+            u_scores[torch.as_tensor(indices, device=self.device)] = answerability_scoring_batch(
+                self.u_model, self.u_tokenizer,
+                questions_b, contexts_b,
+                max_seq_length, self.device)
+
+        def launch_batches(fn, pending, num_contexts_per_question, flush):
+            # pending pairs are grouped by context (shortest first), whatever their question
+            pending.sort(key=lambda i: i % num_contexts_per_question)
+            # complete batches only, the remainder waits for the next sentence's questions unless flush
+            while len(pending) >= batch_size or (flush and len(pending) > 0):
+                runner.submit(fn, pending[:batch_size])
+                del pending[:batch_size]
+
+        # Phase 1 & 2: Question + Choices Generation, and Answering & Answerability of every (question, context) pair in batches
+        # with overlap=True, the batches run on their own stream & thread, overlapping with the question generation of the next sentences
+        # the pending batches are cancelled if anything fails, e.g. the question generation on this thread
+        with AsyncRunner(self.answering_stream) as runner:
+            sent_ids, question_keys = [], []
+            a_index, p_index, u_index = {}, {}, {}
+            answerable = {} # question -> bool
+            num_p_launched = 0 # answerability on the passage, computed inline
+            for sent_id, sentence in enumerate(sentences):
+                questions = question_generation_sentence_level(
+                    self.g1_model, self.g1_tokenizer,
+                    self.g2_model, self.g2_tokenizer,
+                    sentence, passage, num_questions_per_sent, self.device,
+                    max_new_tokens=max_new_tokens)
+                new_questions = [q for q in dict.fromkeys(x['question'] for x in questions) if q not in answerable]
+                if 'AT' in method_params and len(new_questions) > 0:
+                    # bad questions, i.e. not answerable given the passage, score 0.5 whatever the samples say,
+                    # so their answerability on the passage is computed right away (on this thread) and they are not answered at all
+                    p_index.update((q, len(p_examples) + i) for i, q in enumerate(new_questions))
+                    p_examples.extend(new_questions)
+                    for start in range(num_p_launched, len(p_examples), batch_size):
+                        score_passage_answerability(start, min(start + batch_size, len(p_examples)))
+                    u_score_passage = u_scores_passage[num_p_launched:len(p_examples)]
+                    answerable.update(zip(new_questions, (u_score_passage >= kwargs['AT']).tolist()))
+                    num_p_launched = len(p_examples)
+                else:
+                    # bayes_with_alpha does not use the answerability on the passage, so it is not computed
+                    answerable.update((q, True) for q in new_questions)
+                for question_item in questions:
+                    question, options = question_item['question'], question_item['options']
+                    a_key = (question, tuple(options))
+                    sent_ids.append(sent_id)
+                    question_keys.append(a_key)
+                    if not answerable[question]:
+                        continue
+                    # sampled questions often repeat, so each unique question (and options) is only answered once
+                    if a_key not in a_index:
+                        a_index[a_key] = len(a_index)
+                        a_pending.extend(range(len(a_examples), len(a_examples) + num_contexts))
+                        a_examples.extend((question, options, context) for context in sorted_contexts)
+                    if question not in u_index:
+                        u_index[question] = len(u_index)
+                        u_pending.extend(range(len(u_examples), len(u_examples) + num_samples))
+                        u_examples.extend((question, sample) for sample in sorted_samples)
+                is_last_sentence = sent_id == len(sentences) - 1
+                launch_batches(answer, a_pending, num_contexts, flush=is_last_sentence)
+                launch_batches(score_answerability, u_pending, num_samples, flush=is_last_sentence)
+        if len(question_keys) == 0:
+            return np.full((len(sentences),), np.nan)
+        # back to the original order of contexts
+        logits = logits[:len(a_examples)].view(len(a_index), num_contexts, 4)[:, inv_order]
+        u_scores = u_scores[:len(u_examples)].view(len(u_index), num_samples)[:, inv_sample_order]
+
+        # Phase 3: Scoring all (answerable) questions at once, then averaging per sentence
+        scores = torch.full((len(question_keys),), 0.5, device=self.device)
+        good = [i for i, (question, _) in enumerate(question_keys) if answerable[question]]
+        if len(good) > 0:
+            logits = logits[[a_index[question_keys[i]] for i in good]]
+            prob, prob_s = logits[:, 0], logits[:, 1:]
+            u_score = u_scores_passage[[p_index[question_keys[i][0]] for i in good]] if 'AT' in method_params else None
+            u_score_s = u_scores[[u_index[question_keys[i][0]] for i in good]]
+            scores[good] = score_fn(prob, u_score, prob_s, u_score_s, num_samples)
+        sent_ids = torch.tensor(sent_ids, device=scores.device)
+        sent_scores = torch.zeros(len(sentences), dtype=scores.dtype, device=scores.device).index_add_(0, sent_ids, scores)
+        # sentences without any valid question get nan (0/0), as np.mean([]) would
+        sent_scores = sent_scores / torch.bincount(sent_ids, minlength=len(sentences))
+
+        # apart from the answerability of new questions on the passage (counting & bayes), the only device -> host transfer of this call
+        return sent_scores.cpu().numpy().astype(np.float64)
 
 class SelfCheckBERTScore:
     """
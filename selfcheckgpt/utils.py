@@ -35,6 +35,25 @@ def prepare_distractor_input(t5_tokenizer, context, question, answer, device, se
     return input_ids
 
 
+def prepare_distractor_input_batch(t5_tokenizer, context, questions, answers, device, separator='<sep>'):
+    """
+    batched version of prepare_distractor_input: the i-th input is questions[i] <sep> answers[i] <sep> article
+    output: input_ids & attention_mask of dimension (batch_size, seq_length)
+    """
+    input_texts = [question + ' ' + separator + ' ' + answer + ' ' + separator + ' ' + context for question, answer in zip(questions, answers)]
+    encoding = t5_tokenizer(
+        input_texts,
+        padding="longest",
+        return_tensors="pt",
+    )
+    encoding = encoding.to(device)
+    example_encoded = {
+        "input_ids": encoding.input_ids,
+        "attention_mask": encoding.attention_mask,
+    }
+    return example_encoded
+
+
 def prepare_answering_input(
     tokenizer, # longformer_tokenizer
     question, options, context,
@@ -61,6 +80,52 @@ def prepare_answering_input(
 
     return example_encoded
 
+def prepare_answering_input_batch(
+    tokenizer, # longformer_tokenizer
+    questions, options, contexts,
+    device, max_seq_length=4096, pad_to_multiple_of=None,
+):
+    """
+    batched version of prepare_answering_input: the i-th example is (questions[i], options[i], contexts[i])
+    output: input_ids & attention_mask of dimension (batch_size, num_options, seq_length)
+    """
+    batch_size = len(questions)
+    num_options = len(options[0])
+    c_plus_q_4, flat_options = [], []
+    for question, options_, context in zip(questions, options, contexts):
+        c_plus_q = context + ' ' + tokenizer.bos_token + ' ' + question
+        c_plus_q_4.extend([c_plus_q] * num_options)
+        flat_options.extend(options_)
+
+    # padded to the longest sequence in the batch (rounded up to pad_to_multiple_of), not to max_seq_length
+    tokenized_examples = tokenizer(
+        c_plus_q_4, flat_options,
+        max_length=max_seq_length,
+        padding="longest",
+        pad_to_multiple_of=pad_to_multiple_of,
+        truncation=True,
+        return_tensors="pt",
+    )
+    tokenized_examples = tokenized_examples.to(device)
+    input_ids = tokenized_examples['input_ids'].view(batch_size, num_options, -1)
+    attention_mask = tokenized_examples['attention_mask'].view(batch_size, num_options, -1)
+
+    example_encoded = {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+    }
+
+    return example_encoded
+
+def get_attention_window(longformer_config):
+    """
+    Longformer pads every input to a multiple of its (largest) attention window, e.g. 512
+    """
+    attention_window = longformer_config.attention_window
+    if isinstance(attention_window, int):
+        return attention_window
+    return max(attention_window)
+
 # SelfCheck - BERTScore utils
 def expand_list1(mylist, num):
     expanded = []
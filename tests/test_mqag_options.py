@@ -0,0 +1,37 @@
+"""
+Regression checks of the MQAG options builder against the original padding loop
+"""
+import pytest
+
+from selfcheckgpt.modeling_mqag import build_options
+
+def loop_options(answer, distractors):
+    # original (selfcheckgpt 0.1.x), which pads but never truncates
+    options = [answer] + distractors
+    while len(options) < 4:
+        options.append(options[-1])
+    return options
+
+@pytest.mark.parametrize("distractors", [
+    [""],
+    ["b"],
+    ["b", "c"],
+    ["b", "c", "d"],
+    ["b", "b", "d"],
+])
+def test_build_options_pads_as_before(distractors):
+    assert build_options("a", list(distractors)) == loop_options("a", list(distractors))
+
+@pytest.mark.parametrize("distractors", [
+    ["b", "c", "d", "e"],
+    ["b", "c", "d", "e", "f", "g"],
+])
+def test_build_options_truncates_extra_distractors(distractors):
+    options = build_options("a", list(distractors))
+    assert options == loop_options("a", list(distractors))[:4]
+    assert len(options) == 4
+
+def test_build_options_does_not_modify_distractors():
+    distractors = ["b"]
+    build_options("a", distractors)
+    assert distractors == ["b"]
@@ -0,0 +1,124 @@
+"""
+Regression checks of the vectorized SelfCheck-MQAG scoring against the original per-sample loops
+"""
+import numpy as np
+import pytest
+import torch
+
+from selfcheckgpt.modeling_selfcheck import (
+    bayes_score,
+    method_simple_counting,
+    method_vanilla_bayes,
+    method_bayes_with_alpha,
+)
+
+# ---------------------------------------------------------------------------------------- #
+# Original loop implementations (selfcheckgpt 0.1.x)
+def loop_simple_counting(prob, u_score, prob_s, u_score_s, num_samples, AT):
+    if u_score < AT:
+        return 0.5
+    a_DT = np.argmax(prob)
+    count_good_sample, count_match = 0, 0
+    for s in range(num_samples):
+        if u_score_s[s] >= AT:
+            count_good_sample += 1
+            a_S = np.argmax(prob_s[s])
+            if a_DT == a_S:
+                count_match += 1
+    if count_good_sample == 0:
+        score = 0.5
+    else:
+        score = (count_good_sample-count_match) / count_good_sample
+    return score
+
+def loop_bayes_score(count_match, count_mismatch, beta1, beta2):
+    gamma1 = beta2 / (1.0-beta1)
+    gamma2 = beta1 / (1.0-beta2)
+    return (gamma2**count_mismatch) / ((gamma1**count_match) + (gamma2**count_mismatch))
+
+def loop_vanilla_bayes(prob, u_score, prob_s, u_score_s, num_samples, beta1, beta2, AT):
+    if u_score < AT:
+        return 0.5
+    a_DT = np.argmax(prob)
+    count_match, count_mismatch = 0, 0
+    for s in range(num_samples):
+        if u_score_s[s] >= AT:
+            a_S = np.argmax(prob_s[s])
+            if a_DT == a_S:
+                count_match += 1
+            else:
+                count_mismatch += 1
+    return loop_bayes_score(count_match, count_mismatch, beta1, beta2)
+
+def loop_bayes_with_alpha(prob, u_score, prob_s, u_score_s, num_samples, beta1, beta2):
+    a_DT = np.argmax(prob)
+    count_match, count_mismatch = 0, 0
+    for s in range(num_samples):
+        ans_score = u_score_s[s]
+        a_S = np.argmax(prob_s[s])
+        if a_DT == a_S:
+            count_match += ans_score
+        else:
+            count_mismatch += ans_score
+    return loop_bayes_score(count_match, count_mismatch, beta1, beta2)
+
+# ---------------------------------------------------------------------------------------- #
+BETAS = [(0.8, 0.8), (0.3, 0.9), (0.0, 0.8), (0.8, 0.0)]
+ATS = [0.0, 0.5, 1.1] # 1.1 => no good sample (and no answerable question)
+
+def random_inputs(num_questions=32, num_samples=5, seed=0):
+    rng = np.random.default_rng(seed)
+    # few options, so that the answers of the samples often match the passage's one
+    prob = rng.random((num_questions, 4)) * [1.0, 1.0, 0.1, 0.1]
+    prob_s = rng.random((num_questions, num_samples, 4)) * [1.0, 1.0, 0.1, 0.1]
+    u_score = rng.random(num_questions)
+    u_score_s = rng.random((num_questions, num_samples))
+    u_score_s[0] = 0.0 # question without any answerable sample
+    return prob, u_score, prob_s, u_score_s
+
+def check(method, loop_method, **params):
+    prob, u_score, prob_s, u_score_s = random_inputs()
+    num_questions, num_samples = u_score_s.shape
+    expected = [
+        loop_method(prob[i], u_score[i], prob_s[i], u_score_s[i], num_samples, **params)
+        for i in range(num_questions)
+    ]
+    # batched over questions
+    scores = method(
+        torch.tensor(prob), torch.tensor(u_score),
+        torch.tensor(prob_s), torch.tensor(u_score_s),
+        num_samples, **params)
+    np.testing.assert_allclose(scores.numpy(), expected, rtol=1e-5, atol=1e-6)
+    # a single question
+    score = method(
+        torch.tensor(prob[1]), torch.tensor(u_score[1]),
+        torch.tensor(prob_s[1]), torch.tensor(u_score_s[1]),
+        num_samples, **params)
+    np.testing.assert_allclose(score.item(), expected[1], rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize("AT", ATS)
+def test_simple_counting(AT):
+    check(method_simple_counting, loop_simple_counting, AT=AT)
+
+@pytest.mark.parametrize("beta1, beta2", BETAS)
+@pytest.mark.parametrize("AT", ATS)
+def test_vanilla_bayes(beta1, beta2, AT):
+    check(method_vanilla_bayes, loop_vanilla_bayes, beta1=beta1, beta2=beta2, AT=AT)
+
+@pytest.mark.parametrize("beta1, beta2", BETAS)
+def test_bayes_with_alpha(beta1, beta2):
+    check(method_bayes_with_alpha, loop_bayes_with_alpha, beta1=beta1, beta2=beta2)
+
+@pytest.mark.parametrize("beta1, beta2", BETAS + [(0.0, 0.0)])
+def test_bayes_score(beta1, beta2):
+    for count_match in range(4):
+        for count_mismatch in range(4):
+            if beta1 == beta2 == 0.0 and count_match > 0 and count_mismatch > 0:
+                continue # 0 / 0
+            expected = loop_bayes_score(count_match, count_mismatch, beta1, beta2)
+            for dtype in [torch.long, torch.float]:
+                score = bayes_score(
+                    torch.tensor(count_match, dtype=dtype),
+                    torch.tensor(count_mismatch, dtype=dtype),
+                    beta1, beta2)
+                assert score.item() == pytest.approx(expected, rel=1e-5, abs=1e-6)